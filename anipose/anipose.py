@@ -2,12 +2,23 @@
 
 import os
 import os.path
+import logging
+import pickle
+import hashlib
+from copy import deepcopy
+from functools import lru_cache
 import toml
 import click
-import time
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    tomllib = None
 
 pass_config = click.make_pass_decorator(dict)
 
+logger = logging.getLogger("anipose")
+
 DEFAULT_CONFIG = {
     "calibration": {"animal_calibration": False},
     "pipeline": {
@@ -25,6 +36,10 @@ DEFAULT_CONFIG = {
         "videos_combined": "videos-combined",
         "gpus": 0,
         "npool": 1,
+        "video_reader": "opencv",
+        "frame_stride": 1,
+        "inference_scale": 1.0,
+        "poll_interval": 30,
     },
     "filter": {
         "enabled": False,
@@ -36,9 +51,6 @@ DEFAULT_CONFIG = {
     "labeling": {"dot_size": 7},
 }
 
-pause_time = 300
-
-
 def full_path(path):
     path_user = os.path.expanduser(path)
     path_full = os.path.abspath(path_user)
@@ -46,12 +58,71 @@ def full_path(path):
     return path_norm
 
 
+def parse_toml(fname):
+    if tomllib is not None:
+        with open(fname, "rb") as f:
+            return tomllib.load(f)
+    return toml.load(fname)
+
+
+def plain_toml(value):
+    """
+    Converts the dicts of a parsed toml file to plain dicts, as toml
+    parses inline tables into local classes which can't be pickled.
+    """
+    if isinstance(value, dict):
+        return {k: plain_toml(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [plain_toml(v) for v in value]
+    return value
+
+
+@lru_cache(maxsize=4)
+def load_toml_cached(fname, mtime_ns, size):
+    """
+    Parse the toml file `fname`, reusing a pickled copy stored in the
+    anipose cache folder if the file has not changed since.
+    """
+    from .common import get_cache_dir
+
+    key = hashlib.sha1(fname.encode("utf8")).hexdigest()
+    cache_fname = os.path.join(get_cache_dir(), key + ".pkl")
+
+    try:
+        with open(cache_fname, "rb") as f:
+            cached_stat, data = pickle.load(f)
+        if cached_stat == (mtime_ns, size):
+            return data
+    except Exception:
+        pass
+
+    data = plain_toml(parse_toml(fname))
+
+    # write to a temporary file, so a failed dump never leaves
+    # a truncated cache behind
+    tmp_fname = "{}.{}.tmp".format(cache_fname, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        with open(tmp_fname, "wb") as f:
+            pickle.dump(((mtime_ns, size), data), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fname, cache_fname)
+    except Exception:
+        try:
+            os.remove(tmp_fname)
+        except OSError:
+            pass
+
+    return data
+
+
 def load_config(fname):
     if fname is None:
         fname = "config.toml"
 
     if os.path.exists(fname):
-        config = toml.load(fname)
+        stat = os.stat(fname)
+        config = load_toml_cached(full_path(fname), stat.st_mtime_ns, stat.st_size)
+        config = deepcopy(config)
     else:
         config = dict()
 
@@ -69,7 +140,7 @@ def load_config(fname):
 
     for k, v in DEFAULT_CONFIG.items():
         if k not in config:
-            config[k] = v
+            config[k] = deepcopy(v)
         elif isinstance(v, dict):  # handle nested defaults
             for k2, v2 in v.items():
                 if k2 not in config[k]:
@@ -87,6 +158,9 @@ def load_config(fname):
 )
 @click.pass_context
 def cli(ctx, config):
+    from .common import setup_logging
+
+    setup_logging()
     ctx.obj = load_config(config)
 
 
@@ -129,16 +203,55 @@ def calibration_errors(config):
 
 
 @cli.command()
+@click.option(
+    "--frame-stride",
+    type=click.IntRange(min=1),
+    help="Only track every N-th frame, interpolating the others.",
+)
+@click.option(
+    "--scale",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Resize the frames by this factor before tracking.",
+)
 @pass_config
-def analyze(config):
-    from .pose_videos import pose_videos_all
-    from .filter_pose import filter_pose_all
+def analyze(config, frame_stride, scale):
+    from .pose_videos import get_pending_tasks, PoseWorkers
+    from .common import watch_sessions, FileIndex
+
+    if frame_stride is not None:
+        config["pipeline"]["frame_stride"] = frame_stride
+    if scale is not None:
+        config["pipeline"]["inference_scale"] = scale
 
     click.echo("Analyzing videos...")
 
-    while True:
-        pose_videos_all(config)
-        time.sleep(pause_time)
+    # the watcher keeps the index of raw videos up to date,
+    # so the loop never has to list the folders again
+    index = FileIndex(config["pipeline"]["videos_raw"], ".avi")
+    watcher = watch_sessions(
+        config,
+        config["pipeline"]["videos_raw"],
+        ["*.avi"],
+        config["pipeline"]["poll_interval"],
+        index=index,
+    )
+    index.scan(config, merge=True)
+
+    sessions = index.sessions()
+
+    # keep the network loaded on each gpu between new videos
+    with PoseWorkers(config) as workers:
+        while True:
+            # queue the videos of all the sessions before waiting,
+            # so no gpu idles at the end of a session
+            tasks = []
+            for session_path in sessions:
+                tasks += get_pending_tasks(
+                    config, session_path, videos=index.get(session_path)
+                )
+            workers.analyze(tasks)
+            # only revisit the sessions that got new videos
+            sessions = sorted(next(watcher))
 
 
 @cli.command()
@@ -211,27 +324,129 @@ def label_2d(config):
     label_videos_all(config)
 
 
+class StageInputs:
+    """
+    Remembers the input files (and their modification times) each stage
+    last ran on successfully, so that stages are only rerun when their
+    inputs change (or when their last run failed).
+    """
+
+    def __init__(self):
+        self.last = dict()
+
+    def has_run(self, stage):
+        return stage in self.last
+
+    def changed(self, stage, inputs):
+        """
+        Returns the paths in `inputs` that are new or modified since
+        `stage` last ran (all of them on the first run), or None if the
+        inputs did not change at all.
+        """
+        previous = self.last.get(stage)
+        if previous == inputs:
+            return None
+        if previous is None:
+            return list(inputs)
+        return [path for path, mtime in inputs.items() if previous.get(path) != mtime]
+
+    def done(self, stage, inputs):
+        """Records that `stage` ran successfully on `inputs`."""
+        self.last[stage] = inputs
+
+
 @cli.command()
 @pass_config
 def label_2d_filter(config):
     from .label_videos import label_videos_filtered_all
     from .summarize import summarize_pose2d, summarize_pose2d_filtered, summarize_errors
     from .filter_pose import filter_pose_all
+    from .common import watch_sessions, get_file_mtimes
+    from concurrent.futures import ThreadPoolExecutor
 
     click.echo("Labeling (and summarizing) videos in 2D...")
 
-    while True:
-        summarize_pose2d(config)
-    
-        if config["filter"]["enabled"]:
-            filter_pose_all(config)
-            summarize_pose2d_filtered(config)
-
-        summarize_errors(config)
-    
-        label_videos_filtered_all(config)
-     
-        time.sleep(pause_time)
+    watcher = watch_sessions(
+        config,
+        config["pipeline"]["pose_2d"],
+        ["*.h5"],
+        config["pipeline"]["poll_interval"],
+    )
+
+    pipeline = config["pipeline"]
+    filter_enabled = config["filter"]["enabled"]
+    stage_inputs = StageInputs()
+
+    def run_stage(name, fun, *args, **kwargs):
+        # a failed stage is only logged, and its inputs are left
+        # unrecorded so that it runs again on the next tick
+        try:
+            fun(config, *args, **kwargs)
+        except Exception:
+            logger.exception("%s failed, retrying on the next tick", name)
+            return False
+        return True
+
+    def step(ex):
+        pose = get_file_mtimes(config, pipeline["pose_2d"], ".h5")
+
+        if filter_enabled:
+            first = not stage_inputs.has_run("filter")
+            changed = stage_inputs.changed("filter", pose)
+            if changed is not None:
+                # refilter only the pose files that changed since the last run
+                only = None if first else changed
+                if run_stage("filter", filter_pose_all, only=only):
+                    stage_inputs.done("filter", pose)
+
+        pose_filtered = get_file_mtimes(config, pipeline["pose_2d_filter"], ".h5")
+        videos = get_file_mtimes(config, pipeline["videos_raw"], ".avi")
+
+        # the summaries all read h5 files, which pytables can't do from
+        # several threads at once, so they run one after the other
+        summaries = [("summarize_pose2d", summarize_pose2d, pose)]
+        if filter_enabled:
+            summaries += [
+                ("summarize_pose2d_filtered", summarize_pose2d_filtered, pose_filtered)
+            ]
+        summaries += [("summarize_errors", summarize_errors, pose_filtered)]
+
+        summaries = [
+            (name, fun, inputs) for name, fun, inputs in summaries
+            if stage_inputs.changed(name, inputs) is not None
+        ]
+
+        def summarize(config):
+            for name, summarize_fun, inputs in summaries:
+                if run_stage(name, summarize_fun):
+                    stage_inputs.done(name, inputs)
+
+        futures = [ex.submit(summarize, config)]
+
+        # the labeled videos count as inputs too, so that missing or
+        # removed outputs are labeled again
+        def get_label_inputs():
+            labeled = get_file_mtimes(config, pipeline["videos_labeled_2d_filter"], ".avi")
+            return {**pose_filtered, **videos, **labeled}
+
+        def label(config):
+            if run_stage("label", label_videos_filtered_all):
+                # the outputs as written by this run
+                stage_inputs.done("label", get_label_inputs())
+
+        if stage_inputs.changed("label", get_label_inputs()) is not None:
+            # labeling videos is the slow part, summarize in the meantime
+            futures.append(ex.submit(label, config))
+
+        for future in futures:
+            future.result()
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        while True:
+            step(ex)
+
+            # wait until some new pose file shows up
+            next(watcher)
 
 
 @cli.command()
@@ -348,50 +563,47 @@ def check_progress(config):
     _check_progress(config)
    
 def __check_progress(config, session_path):
-    from glob import glob
-    from .common import natural_keys, get_nframes
+    from concurrent.futures import ThreadPoolExecutor
+    from .common import natural_keys, get_nframes, list_files
 
     pipeline_videos_raw = config['pipeline']['videos_raw']
     pipeline_pose = config['pipeline']['pose_2d']
 
-    config_name = os.path.join(config['model_folder'], 'config.yaml')
-
     source_folder = os.path.join(session_path, pipeline_videos_raw)
     outdir = os.path.join(session_path, pipeline_pose)
 
-    videos = glob(os.path.join(source_folder, '*.avi'))
+    videos = list_files(source_folder, '.avi')
     videos = sorted(videos, key=natural_keys)
-    
-    n_analyzed = 0
-    n_labeled  = 0
-
-    for video in videos:
-        basename = os.path.basename(video)
-        basename, ext = os.path.splitext(basename)
-        
-        dataname = os.path.join(outdir, basename + '.h5')
-        
-        if os.path.exists(dataname):   
-            n_analyzed += 1
-    
+
+    analyzed = set(list_files(outdir, '.h5'))
+    n_analyzed = sum(1 for video in videos
+                     if os.path.splitext(video)[0] + '.h5' in analyzed)
+
     pipeline_videos_labeled = config['pipeline']['videos_labeled_2d_filter']
     pipeline_pose = config['pipeline']['pose_2d_filter']
 
-    labels_fnames = glob(os.path.join(session_path, pipeline_pose, '*.h5'))
+    labels_fnames = list_files(os.path.join(session_path, pipeline_pose), '.h5')
     labels_fnames = sorted(labels_fnames, key=natural_keys)
 
     outdir = os.path.join(session_path, pipeline_videos_labeled)
-    
+    labeled = set(list_files(outdir, '.avi'))
+    videos_set = set(videos)
+
+    vidnames = []
+    out_fnames = []
     for fname in labels_fnames:
-        basename = os.path.basename(fname)
-        basename = os.path.splitext(basename)[0]
-        out_fname = os.path.join(outdir, basename+'.avi')
-        vidname = os.path.join(session_path, pipeline_videos_raw, basename+'.avi')
-        if os.path.exists(vidname):
-            if os.path.exists(out_fname) and \
-               abs(get_nframes(out_fname) - get_nframes(vidname)) < 100:
-                n_labeled += 1
-    
+        vidname = os.path.splitext(fname)[0] + '.avi'
+        if vidname in videos_set and vidname in labeled:
+            vidnames.append(os.path.join(source_folder, vidname))
+            out_fnames.append(os.path.join(outdir, vidname))
+
+    # reading the number of frames is slow, so check the videos in parallel
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        nframes_out = list(ex.map(get_nframes, out_fnames))
+        nframes_raw = list(ex.map(get_nframes, vidnames))
+
+    n_labeled = sum(1 for a, b in zip(nframes_out, nframes_raw) if abs(a - b) < 100)
+
     if len(videos)>0:
         print(os.path.basename(session_path))
         print('    Analyzed: ', n_analyzed, ' out of ', len(videos), ' videos.')
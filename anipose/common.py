@@ -3,7 +3,16 @@
 import cv2
 from cv2 import aruco
 import re
+import atexit
 import os, os.path
+import sys
+import time
+import logging
+import logging.handlers
+import queue
+import shelve
+import threading
+from functools import lru_cache, wraps
 from collections import deque
 from glob import glob
 import skvideo.io
@@ -13,16 +22,59 @@ import numpy as np
 import pandas as pd
 
 
+class BufferedHandler(logging.handlers.MemoryHandler):
+    """
+    Buffers log records and writes them to `target` in one go, when
+    `capacity` records piled up, on warnings, or at least every
+    `interval` seconds.
+    """
+
+    def __init__(self, target, capacity=64, interval=1):
+        super().__init__(capacity, flushLevel=logging.WARNING, target=target)
+        self.interval = interval
+        self.flusher_pid = None
+
+    def emit(self, record):
+        # (re)start the flushing thread, which doesn't survive a fork
+        if self.flusher_pid != os.getpid():
+            self.flusher_pid = os.getpid()
+            threading.Thread(target=self.flush_periodically, daemon=True).start()
+        super().emit(record)
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+def setup_logging():
+    logger = logging.getLogger("anipose")
+    if len(logger.handlers) == 0:
+        target = logging.StreamHandler(sys.stdout)
+        logger.addHandler(BufferedHandler(target))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def flush_logging():
+    for handler in logging.getLogger("anipose").handlers:
+        handler.flush()
+
+
 def atoi(text):
     return int(text) if text.isdigit() else text
 
 
+_natural_keys_re = re.compile(r"(\d+)")
+
+
 def natural_keys(text):
     """
     alist.sort(key=natural_keys) sorts in human order
     http://nedbatchelder.com/blog/200712/human_sorting.html
     """
-    return [atoi(c) for c in re.split("(\d+)", text)]
+    return tuple([atoi(c) for c in _natural_keys_re.split(text)])
 
 
 def wc(filename):
@@ -66,6 +118,22 @@ def true_basename(fname):
     return basename
 
 
+def list_files(folder, ext):
+    """
+    Names of the (non hidden) files in `folder` ending with `ext`,
+    from a single directory scan. Returns an empty list if `folder`
+    does not exist.
+    """
+    try:
+        with os.scandir(folder) as it:
+            return [
+                e.name for e in it
+                if e.name.endswith(ext) and not e.name.startswith(".")
+            ]
+    except FileNotFoundError:
+        return []
+
+
 def get_cam_name(config, fname):
     try:
         basename = true_basename(fname)
@@ -95,7 +163,117 @@ def get_duration(vidname):
     return duration
 
 
-def get_nframes(vidname):
+def get_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "anipose")
+
+
+class FileStatStore:
+    """
+    The on-disk part of `cache_on_file_stat`: a shelve called `name` in the
+    anipose cache folder. Opening a shelve is slow (dbm.dumb reads and
+    rewrites its whole index), so it is read once, on first use, and new
+    entries are written back every `flush_every` entries and at exit.
+    The store is best effort, another process may hold it.
+    """
+
+    def __init__(self, name, flush_every=1000):
+        self.name = name
+        self.flush_every = flush_every
+        self.entries = None
+        self.new = dict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            return self.entries.get(path)
+
+    def put(self, path, entry):
+        with self.lock:
+            self.entries[path] = entry
+            self.new[path] = entry
+            if len(self.new) >= self.flush_every:
+                self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def load(self):
+        self.entries = dict()
+        try:
+            with shelve.open(self.db_fname(), flag="r") as db:
+                self.entries.update(db.items())
+        except Exception:
+            pass
+        atexit.register(self.flush)
+
+    def write(self):
+        if len(self.new) == 0:
+            return
+        try:
+            os.makedirs(get_cache_dir(), exist_ok=True)
+            with shelve.open(self.db_fname()) as db:
+                db.update(self.new)
+        except Exception:
+            pass
+        self.new = dict()
+
+    def db_fname(self):
+        return os.path.join(get_cache_dir(), self.name)
+
+
+def cache_on_file_stat(name):
+    """
+    Decorator memoizing `fun(fname)` on the absolute path, modification time
+    and size of `fname`, both in memory and in a FileStatStore called `name`,
+    so unchanged files are never probed twice.
+    """
+
+    def decorator(fun):
+        store = FileStatStore(name)
+
+        @lru_cache(maxsize=65536)
+        def cached(path, mtime_ns, size):
+            entry = store.get(path)
+            if entry is not None:
+                stat, value = entry
+                if stat == (mtime_ns, size):
+                    return value
+
+            value = fun(path)
+            store.put(path, ((mtime_ns, size), value))
+            return value
+
+        @wraps(fun)
+        def wrapper(fname):
+            path = os.path.abspath(fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return fun(fname)
+            return cached(path, stat.st_mtime_ns, stat.st_size)
+
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+
+    return decorator
+
+
+def get_nframes_av(vidname):
+    # reads the frame count from the container header, without decoding
+    import av
+
+    try:
+        with av.open(vidname) as container:
+            return container.streams.video[0].frames
+    except (av.error.FFmpegError, IndexError):
+        return 0
+
+
+def get_nframes_ffprobe(vidname):
     try:
         metadata = skvideo.io.ffprobe(vidname)
         length = int(metadata["video"]["@nb_frames"])
@@ -104,6 +282,18 @@ def get_nframes(vidname):
         return 0
 
 
+@cache_on_file_stat("nframes")
+def get_nframes(vidname):
+    try:
+        length = get_nframes_av(vidname)
+    except ImportError:
+        length = 0
+    # the header doesn't always have the frame count
+    if length == 0:
+        length = get_nframes_ffprobe(vidname)
+    return length
+
+
 def full_path(path):
     path_user = os.path.expanduser(path)
     path_full = os.path.abspath(path_user)
@@ -180,6 +370,238 @@ def make_process_fun(process_session, **args):
     return fun
 
 
+def get_session_paths(config):
+    output = process_all(config, lambda config, session_path: session_path)
+    return [output[key] for key in sorted(output.keys())]
+
+
+def get_file_mtimes(config, folder, ext):
+    """
+    Modification times (in ns) of the files ending with `ext` in the
+    `folder` subfolder of every session, keyed by path.
+    """
+    mtimes = dict()
+    for session_path in get_session_paths(config):
+        path = os.path.join(session_path, folder)
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.name.endswith(ext) and not e.name.startswith("."):
+                        mtimes[e.path] = e.stat().st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return mtimes
+
+
+class FileIndex:
+    """
+    In-memory listing of the files ending with `ext` in the `folder`
+    subfolder of each session. It is filled with one scan by `scan`, then
+    kept up to date by `watch_sessions`, so polling loops don't need to
+    list the folders again.
+    """
+
+    def __init__(self, folder, ext):
+        self.folder = folder
+        self.ext = ext
+        self.files = dict()
+        self.lock = threading.Lock()
+
+    def scan(self, config, sessions=None, merge=False):
+        """
+        Lists the folders of `sessions` (all of them by default). With
+        `merge`, files already in the index are kept, so that files
+        reported by the watcher during the scan are not lost.
+        """
+        if sessions is None:
+            sessions = get_session_paths(config)
+        for session_path in sessions:
+            path = os.path.join(session_path, self.folder)
+            files = {os.path.join(path, fname) for fname in list_files(path, self.ext)}
+            with self.lock:
+                if merge:
+                    files |= self.files.get(session_path, set())
+                self.files[session_path] = files
+
+    def add(self, session_path, path):
+        if path.endswith(self.ext):
+            with self.lock:
+                self.files.setdefault(session_path, set()).add(path)
+
+    def discard(self, session_path, path):
+        with self.lock:
+            self.files.get(session_path, set()).discard(path)
+
+    def sessions(self):
+        with self.lock:
+            return sorted(self.files.keys())
+
+    def get(self, session_path):
+        with self.lock:
+            return list(self.files.get(session_path, ()))
+
+
+def poll_sessions(config, poll_interval, index=None):
+    while True:
+        time.sleep(poll_interval)
+        sessions = set(get_session_paths(config))
+        if index is not None:
+            index.scan(config, sessions)
+        yield sessions
+
+
+def get_file_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+def drain_sessions(q, observer, debounce, ready, poll_interval, rescan):
+    """
+    Turns the ("write" | "done" | "deleted", path) events on `q` into sets
+    of session paths. A file is complete once it was closed or moved into
+    place ("done"), or once it saw no write and kept the same size for
+    `debounce` seconds; `ready(path)` is then called and returns its session.
+    Complete files are collected for `debounce` seconds before yielding.
+    As a safety net for missed events (e.g. files written by another host
+    on a network mount), every session returned by `rescan()` is also
+    yielded each `poll_interval` seconds.
+    """
+    pending = dict()  # path -> size at the last check, None if just written
+    sessions = set()
+    next_check = None
+    next_rescan = time.time() + poll_interval
+    try:
+        while True:
+            deadline = next_rescan
+            if next_check is not None:
+                deadline = min(deadline, next_check)
+            try:
+                kind, path = q.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                if next_check is not None and time.time() >= next_check:
+                    for path, size in list(pending.items()):
+                        new_size = get_file_size(path)
+                        if new_size is None or new_size == size:
+                            del pending[path]
+                        else:
+                            pending[path] = new_size
+                        if new_size is not None and new_size == size:
+                            sessions.add(ready(path))
+                    if len(pending) > 0:
+                        next_check = time.time() + debounce
+                    else:
+                        next_check = None
+                if time.time() >= next_rescan:
+                    sessions |= rescan()
+                if len(sessions) > 0:
+                    yield sessions
+                    sessions = set()
+                if time.time() >= next_rescan:
+                    next_rescan = time.time() + poll_interval
+                continue
+
+            if kind == "write":
+                pending[path] = None
+            elif kind == "done":
+                pending.pop(path, None)
+                sessions.add(ready(path))
+            elif kind == "deleted":
+                pending.pop(path, None)
+            if next_check is None:
+                next_check = time.time() + debounce
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def watch_sessions(config, folder, patterns, poll_interval, debounce=2,
+                   index=None):
+    """
+    Returns an iterator over sets of session paths whose `folder` subfolder
+    received a new file matching one of `patterns` (e.g. ["*.avi"]).
+    Watching starts right away, so files added before the first `next`
+    are not missed. Files only count once they are completely written
+    (see drain_sessions), so a video being copied isn't analyzed halfway.
+    If a FileIndex `index` is given, it is updated as files come and go.
+    Every session is also yielded (and `index` rescanned) each
+    `poll_interval` seconds, to catch the files the watcher missed.
+    If watchdog is not installed, or the folders can't be watched (e.g.
+    the inotify watch limit is reached), only polls this way.
+    """
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import PatternMatchingEventHandler
+    except ImportError:
+        return poll_sessions(config, poll_interval, index)
+
+    suffix = os.sep + os.path.normpath(folder)
+    q = queue.Queue()
+
+    def get_session(path):
+        folder_path = os.path.dirname(path)
+        if folder_path.endswith(suffix):
+            return folder_path[: -len(suffix)]
+        return None
+
+    def push(kind, path):
+        if get_session(path) is not None:
+            q.put((kind, path))
+
+    def ready(path):
+        session_path = get_session(path)
+        if index is not None:
+            index.add(session_path, path)
+        return session_path
+
+    def remove(path):
+        session_path = get_session(path)
+        if session_path is not None:
+            if index is not None:
+                index.discard(session_path, path)
+            q.put(("deleted", path))
+
+    class Handler(PatternMatchingEventHandler):
+        def on_created(self, event):
+            push("write", event.src_path)
+
+        def on_modified(self, event):
+            push("write", event.src_path)
+
+        # only emitted by watchdog >= 2.1 on linux, elsewhere files
+        # are complete once their size stops changing
+        def on_closed(self, event):
+            push("done", event.src_path)
+
+        def on_moved(self, event):
+            remove(event.src_path)
+            push("done", event.dest_path)
+
+        def on_deleted(self, event):
+            remove(event.src_path)
+
+    handler = Handler(patterns=patterns, ignore_directories=True)
+    observer = Observer()
+    try:
+        observer.schedule(handler, config["path"], recursive=True)
+        observer.start()
+    except OSError as e:
+        observer.stop()
+        logging.getLogger("anipose").warning(
+            "could not watch %s, polling instead: %s", config["path"], e
+        )
+        return poll_sessions(config, poll_interval, index)
+
+    def rescan():
+        sessions = set(get_session_paths(config))
+        if index is not None:
+            index.scan(config, sessions)
+        return sessions
+
+    return drain_sessions(q, observer, debounce, ready, poll_interval, rescan)
+
+
 def find_calibration_folder(config, session_path):
     pipeline_calibration_videos = config["pipeline"]["calibration_videos"]
     nesting = config["nesting"]
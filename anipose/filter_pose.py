@@ -9,7 +9,7 @@ from glob import glob
 from scipy import signal
 from scipy.interpolate import splev, splrep
 
-from .common import make_process_fun, natural_keys
+from .common import process_all, natural_keys
 
 
 def nan_helper(y):
@@ -68,7 +68,12 @@ def filter_pose(config, fname, outname):
     dout.to_hdf(outname, "df_with_missing", format="table", mode="w")
 
 
-def process_session(config, session_path):
+def process_session(config, session_path, only=None):
+    """
+    Filters the pose files of the session which were not filtered yet.
+    If `only` is given, filters the pose files in `only` instead,
+    even if they were filtered before.
+    """
     pipeline_pose = config["pipeline"]["pose_2d"]
     pipeline_pose_filter = config["pipeline"]["pose_2d_filter"]
 
@@ -78,6 +83,10 @@ def process_session(config, session_path):
     pose_files = glob(os.path.join(pose_folder, "*.h5"))
     pose_files = sorted(pose_files, key=natural_keys)
 
+    if only is not None:
+        only = set(only)
+        pose_files = [fname for fname in pose_files if fname in only]
+
     if len(pose_files) > 0:
         os.makedirs(output_folder, exist_ok=True)
 
@@ -85,11 +94,12 @@ def process_session(config, session_path):
         basename = os.path.basename(fname)
         outpath = os.path.join(session_path, pipeline_pose_filter, basename)
 
-        if os.path.exists(outpath):
+        if only is None and os.path.exists(outpath):
             continue
 
         print(outpath)
         filter_pose(config, fname, outpath)
 
 
-filter_pose_all = make_process_fun(process_session)
+def filter_pose_all(config, only=None):
+    return process_all(config, process_session, only=only)
@@ -10,10 +10,10 @@ from tqdm import trange
 
 from matplotlib.pyplot import get_cmap
 
-from multiprocessing import Pool
+import multiprocessing as mp
 from itertools import repeat
 
-from .common import make_process_fun, natural_keys
+from .common import make_process_fun, natural_keys, get_nframes
 
 
 def get_duration(vidname):
@@ -22,12 +22,6 @@ def get_duration(vidname):
     return duration
 
 
-def get_nframes(vidname):
-    metadata = skvideo.io.ffprobe(vidname)
-    length = int(metadata["video"]["@nb_frames"])
-    return length
-
-
 def connect(img, points, bps, bodyparts, col=(0, 255, 0, 255)):
     try:
         ixs = [bodyparts.index(bp) for bp in bps]
@@ -170,7 +164,13 @@ def process_session(config, session_path, filtered=False):
     
     #for i in range(len(fnames)):
     #    visualize_labels(config, fnames[i], vidnames[i], out_fnames[i])
-    with Pool(n_pool) as p:
+
+    if len(fnames) == 0:
+        return
+
+    # spawn rather than fork, as label-2d-filter runs this alongside
+    # threads reading h5 files
+    with mp.get_context("spawn").Pool(n_pool) as p:
         p.starmap(visualize_labels, zip(repeat(config), fnames, vidnames, out_fnames))
 
 
@@ -4,79 +4,670 @@ import os.path
 
 # Dependencies for video:
 import os
+import sys
+import importlib.util
+import traceback
+import logging
 from glob import glob
-import io
-from contextlib import redirect_stdout
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Thread
 import deeplabcut
 import numpy as np
+import pandas as pd
+import cv2
 
-from .common import natural_keys, make_process_fun
+from .common import (
+    natural_keys,
+    process_all,
+    true_basename,
+    list_files,
+    setup_logging,
+    flush_logging,
+)
 
-from multiprocessing import Pool
-from itertools import repeat
+import multiprocessing as mp
+from itertools import chain
 
+# scorer names of DeepLabCut 2.0 and 2.1+ outputs
+DLC_SCORER_PREFIXES = ("DeepCut", "DLC")
 
-def rename_dlc_files(folder, base):
-    files = glob(os.path.join(folder, base + "*"))
-    for fname in files:
-        basename = os.path.basename(fname)
-        _, ext = os.path.splitext(basename)
-        os.rename(os.path.join(folder, basename), os.path.join(folder, base + ext))
+VIDEO_READERS = ("opencv", "decord")
 
+logger = logging.getLogger("anipose")
 
-def process_session(config, session_path):
-    pipeline_videos_raw = config["pipeline"]["videos_raw"]
-    pipeline_pose = config["pipeline"]["pose_2d"]
-    gpus = config["pipeline"]["gpus"]
 
+@contextmanager
+def suppress_output():
+    """
+    Silences stdout and stderr at the file descriptor level, so the output
+    of C extensions (e.g. tensorflow) is dropped too, without buffering it.
+    """
+    flush_logging()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    saved = [os.dup(1), os.dup(2)]
     try:
-        n_gpus = len(gpus)
-    except:
-        gpus = None
-        n_gpus = 1
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+
+
+def rename_dlc_files(folder, bases):
+    """
+    Renames the DeepLabCut outputs in `folder` of each video basename in
+    `bases` (e.g. "vid1DLC_resnet50_...h5") to drop the scorer name
+    ("vid1.h5"), using a single scan of the folder.
+    """
+    bases = set(bases)
+    lengths = sorted({len(base) for base in bases}, reverse=True)
+
+    for fname in list_files(folder, ""):
+        # longest matching base first, so "vid1" doesn't take "vid10" files
+        for n in lengths:
+            base, rest = fname[:n], fname[n:]
+            if base in bases and rest.startswith(DLC_SCORER_PREFIXES):
+                _, ext = os.path.splitext(rest)
+                os.rename(os.path.join(folder, fname), os.path.join(folder, base + ext))
+                break
+
+
+class PosePredictor:
+    """
+    Runs a DeepLabCut network on videos, keeping the network loaded
+    between videos. Decoding, inference and writing of the outputs run
+    in separate stages (reader thread, calling thread, writer thread)
+    connected by bounded queues, so the GPU does not wait on video I/O.
+    To go faster, the network can be run on every `frame_stride`-th frame
+    only (the other frames are interpolated), and on frames resized by
+    `scale`.
+    Raises ImportError if this version of DeepLabCut does not expose the
+    internals needed (these are not public API and may change).
+    """
+
+    def __init__(self, config_name, gpu=None, batch_size=None,
+                 video_reader="opencv", frame_stride=1, scale=1,
+                 shuffle=1, trainingsetindex=0, prefetch=64):
+        if video_reader not in VIDEO_READERS:
+            raise ValueError(
+                "video_reader should be one of {} not '{}'".format(
+                    VIDEO_READERS, video_reader
+                )
+            )
+        if video_reader == "decord" and importlib.util.find_spec("decord") is None:
+            raise ValueError("video_reader = 'decord' requires the decord package")
+        if not (isinstance(frame_stride, int) and frame_stride >= 1):
+            raise ValueError(
+                "frame_stride should be a positive integer not {}".format(frame_stride)
+            )
+        if not (isinstance(scale, (int, float)) and scale > 0):
+            raise ValueError("inference_scale should be positive not {}".format(scale))
+
+        from deeplabcut.utils import auxiliaryfunctions
+        from deeplabcut.pose_estimation_tensorflow.config import load_config
+        from deeplabcut.pose_estimation_tensorflow.nnet import predict
+
+        required = [
+            (auxiliaryfunctions, "read_config"),
+            (auxiliaryfunctions, "GetModelFolder"),
+            (auxiliaryfunctions, "GetScorerName"),
+            (predict, "setup_pose_prediction"),
+            (predict, "getposeNP"),
+        ]
+        missing = [name for module, name in required if not hasattr(module, name)]
+        if len(missing) > 0:
+            raise ImportError(
+                "deeplabcut does not provide {}".format(", ".join(missing))
+            )
+
+        if gpu is not None:
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
+
+        cfg = auxiliaryfunctions.read_config(config_name)
+        for key in ["TrainingFraction", "snapshotindex", "batch_size"]:
+            if key not in cfg:
+                raise ImportError("deeplabcut config has no '{}' key".format(key))
+        train_fraction = cfg["TrainingFraction"][trainingsetindex]
+        modelfolder = os.path.join(
+            cfg["project_path"],
+            str(auxiliaryfunctions.GetModelFolder(train_fraction, shuffle, cfg)),
+        )
+        dlc_cfg = load_config(os.path.join(modelfolder, "test", "pose_cfg.yaml"))
+
+        train_folder = os.path.join(modelfolder, "train")
+        snapshots = [
+            fn.split(".")[0] for fn in os.listdir(train_folder) if "index" in fn
+        ]
+        snapshots = sorted(snapshots, key=lambda x: int(x.split("-")[1]))
+        snapshotindex = cfg["snapshotindex"]
+        if snapshotindex == "all":
+            snapshotindex = -1
+        dlc_cfg["init_weights"] = os.path.join(train_folder, snapshots[snapshotindex])
+        iterations = dlc_cfg["init_weights"].split("-")[-1]
+
+        if batch_size is None:
+            batch_size = cfg["batch_size"]
+        dlc_cfg["batch_size"] = batch_size
+
+        scorer = auxiliaryfunctions.GetScorerName(
+            cfg, shuffle, train_fraction, trainingsiterations=iterations
+        )
+        if isinstance(scorer, tuple):  # newer versions also return legacy name
+            scorer = scorer[0]
+
+        if cfg.get("cropping", False):
+            self.crop = (cfg["x1"], cfg["x2"], cfg["y1"], cfg["y2"])
+        else:
+            self.crop = None
+
+        self.predict = predict
+        self.dlc_cfg = dlc_cfg
+        self.gpu = gpu
+        self.video_reader = video_reader
+        self.frame_stride = frame_stride
+        self.scale = scale
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.sess, self.inputs, self.outputs = predict.setup_pose_prediction(dlc_cfg)
+        self.columns = pd.MultiIndex.from_product(
+            [[scorer], dlc_cfg["all_joints_names"], ["x", "y", "likelihood"]],
+            names=["scorer", "bodyparts", "coords"],
+        )
+
+    def read_video_opencv(self, video, put):
+        cap = cv2.VideoCapture(video)
+        n = 0
+        try:
+            while True:
+                if n % self.frame_stride != 0:
+                    # skip the frame without converting it
+                    if not cap.grab():
+                        break
+                else:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    put(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                n += 1
+        finally:
+            cap.release()
+        return n
+
+    def read_video_decord(self, video, put):
+        import decord
+
+        # decode on the gpu (NVDEC) when decord is built with cuda support
+        try:
+            if self.gpu is None:
+                raise decord.DECORDError("no gpu specified")
+            # CUDA_VISIBLE_DEVICES leaves only our gpu visible
+            vr = decord.VideoReader(video, ctx=decord.gpu(0))
+        except decord.DECORDError:
+            vr = decord.VideoReader(video, ctx=decord.cpu(0))
+
+        n = len(vr)
+        indices = list(range(0, n, self.frame_stride))
+        for start in range(0, len(indices), self.batch_size):
+            batch = vr.get_batch(indices[start : start + self.batch_size])
+            # decord already gives frames in RGB
+            for frame in batch.asnumpy():
+                put(frame)
+        return n
+
+    def prepare_frame(self, frame):
+        if self.crop is not None:
+            x1, x2, y1, y2 = self.crop
+            frame = frame[y1:y2, x1:x2]
+        if self.scale != 1:
+            frame = cv2.resize(
+                frame, None, fx=self.scale, fy=self.scale,
+                interpolation=cv2.INTER_AREA,
+            )
+        return frame
+
+    def read_frames(self, tasks, read_q):
+        if self.video_reader == "decord":
+            read_video = self.read_video_decord
+        else:
+            read_video = self.read_video_opencv
+
+        def put(frame):
+            read_q.put(("frame", self.prepare_frame(frame)))
+
+        try:
+            for video, outdir in tasks:
+                try:
+                    nframes = read_video(video, put)
+                except Exception as e:
+                    # a broken video shouldn't stop the others
+                    read_q.put(("failed", (video, outdir, e)))
+                    continue
+                read_q.put(("end", (video, outdir, nframes)))
+            read_q.put(("done", None))
+        except Exception as e:
+            read_q.put(("error", e))
+
+    def write_poses(self, write_q, callback, error_callback):
+        chunks = []
+        while True:
+            kind, value = write_q.get()
+            if kind == "done":
+                return
+            if kind == "poses":
+                chunks.append(value)
+                continue
+            if kind == "failed":
+                video, outdir, e = value
+                error_callback(video, outdir, e)
+            else:
+                video, outdir, _ = value
+                try:
+                    self.write_video_poses(chunks, *value)
+                except Exception as e:
+                    # report right away, the main loop may be idle waiting
+                    # for the next video
+                    error_callback(video, outdir, e)
+                else:
+                    if callback is not None:
+                        callback(video, outdir)
+            chunks = []
+
+    def write_video_poses(self, chunks, video, outdir, nframes):
+        # an empty pose file would mark the video as done for good
+        if nframes == 0 or len(chunks) == 0:
+            raise ValueError("could not read any frames from {}".format(video))
+        poses = np.vstack(chunks)
+
+        if self.scale != 1:
+            poses[:, 0::3] /= self.scale
+            poses[:, 1::3] /= self.scale
+
+        if self.frame_stride != 1:
+            # linearly interpolate the poses of the skipped frames
+            ixs = np.arange(len(poses)) * self.frame_stride
+            ixs_all = np.arange(nframes)
+            poses = np.stack(
+                [np.interp(ixs_all, ixs, poses[:, i]) for i in range(poses.shape[1])],
+                axis=1,
+            )
+
+        if self.crop is not None:
+            x1, _, y1, _ = self.crop
+            poses[:, 0::3] += x1
+            poses[:, 1::3] += y1
+
+        basename = true_basename(video)
+        dataname = os.path.join(outdir, basename + ".h5")
+        csvname = os.path.join(outdir, basename + ".csv")
+
+        data = pd.DataFrame(poses, columns=self.columns, index=range(len(poses)))
+        # write to a temporary file, so a partial output is never
+        # mistaken for a finished one
+        tmpname = dataname + ".part"
+        data.to_hdf(tmpname, key="df_with_missing", format="table", mode="w")
+        data.to_csv(csvname)
+        os.replace(tmpname, dataname)
+
+    def infer(self, frames):
+        n = len(frames)
+        batch = np.zeros((self.batch_size,) + frames[0].shape, dtype=frames[0].dtype)
+        batch[:n] = frames
+        poses = self.predict.getposeNP(
+            batch, self.dlc_cfg, self.sess, self.inputs, self.outputs
+        )
+        return np.reshape(poses, (self.batch_size, -1))[:n]
+
+    def analyze(self, tasks, callback=None, error_callback=None):
+        """
+        Analyzes each (video, outdir) pair from the iterable `tasks`, which
+        is consumed lazily by the reader thread.
+        `callback(video, outdir)` is called once the output of a video is written,
+        `error_callback(video, outdir, error)` if reading or writing it failed,
+        after which the next videos are still analyzed. Without
+        `error_callback`, the first such error is raised at the end.
+        """
+        read_q = Queue(maxsize=self.prefetch)
+        write_q = Queue(maxsize=self.prefetch)
+        errors = []
+
+        if error_callback is None:
+            def error_callback(video, outdir, e):
+                errors.append(e)
+
+        reader = Thread(target=self.read_frames, args=(tasks, read_q), daemon=True)
+        writer = Thread(target=self.write_poses, args=(write_q, callback, error_callback))
+        reader.start()
+        writer.start()
+
+        try:
+            frames = []
+            while True:
+                kind, value = read_q.get()
+                if kind == "error":
+                    raise value
+                if kind == "failed":
+                    # drop the frames read before the video broke
+                    frames = []
+                    write_q.put(("failed", value))
+                    continue
+                if kind == "frame":
+                    frames.append(value)
+                    if len(frames) < self.batch_size:
+                        continue
+
+                if len(frames) > 0:
+                    write_q.put(("poses", self.infer(frames)))
+                    frames = []
+
+                if kind == "end":
+                    write_q.put(("end", value))
+                elif kind == "done":
+                    break
+        finally:
+            write_q.put(("done", None))
+            writer.join()
+
+        if len(errors) > 0:
+            raise errors[0]
 
-    config_name = os.path.join(config["model_folder"], "config.yaml")
+    def analyze_videos(self, videos, outdir):
+        self.analyze((video, outdir) for video in videos)
+
+
+class PoseWorkers:
+    """
+    One worker process per gpu, each taking the next video from a shared
+    queue as soon as it is free, so no gpu sits idle while another one has
+    a long queue. The workers load the network on their first video and
+    keep it loaded until closed, so they can be reused across sessions
+    (and across the polling loop of anipose analyze). The processes are
+    only started once there is a video to analyze, as each of them imports
+    deeplabcut and tensorflow. Videos which could not be analyzed are
+    logged and not tried again by these workers.
+    """
+
+    def __init__(self, config, max_workers=None):
+        gpus = config["pipeline"]["gpus"]
+        try:
+            gpus = list(gpus)
+        except TypeError:
+            gpus = [None]
+
+        if max_workers is not None:
+            gpus = gpus[:max_workers]
+
+        config_name = os.path.join(config["model_folder"], "config.yaml")
+        options = {
+            "batch_size": config["pipeline"].get("dlc_batch_size", None),
+            "video_reader": config["pipeline"]["video_reader"],
+            "frame_stride": config["pipeline"]["frame_stride"],
+            "scale": config["pipeline"]["inference_scale"],
+        }
+
+        self.gpus = gpus
+        self.config_name = config_name
+        self.options = options
+        self.workers = []
+        self.failed = set()
+
+    def start(self):
+        # spawn rather than fork, the parent may already run threads
+        # (the file watcher, the log flusher) which don't fork safely
+        ctx = mp.get_context("spawn")
+        self.task_q = ctx.Queue()
+        self.done_q = ctx.Queue()
+        self.workers = [
+            ctx.Process(
+                target=process_gpu_queue,
+                args=(self.config_name, self.task_q, self.done_q, gpu, self.options),
+                daemon=True,
+            )
+            for gpu in self.gpus
+        ]
+        for w in self.workers:
+            w.start()
+
+    def analyze(self, tasks):
+        """
+        Analyzes each video of the (video, outdir) pairs in `tasks`,
+        returning once all are done. Passing the videos of several sessions
+        at once keeps every gpu busy until the last few videos.
+        """
+        tasks = [(video, outdir) for video, outdir in tasks if video not in self.failed]
+        if len(tasks) == 0:
+            return
+        if len(self.workers) == 0:
+            self.start()
+
+        for task in tasks:
+            self.task_q.put(task)
+
+        remaining = len(tasks)
+        while remaining > 0:
+            try:
+                kind, value = self.done_q.get(timeout=1)
+            except Empty:
+                dead = [gpu for gpu, w in zip(self.gpus, self.workers)
+                        if not w.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError(
+                        "pose estimation worker died on gpus {}".format(dead)
+                    )
+                continue
+            if kind == "error":
+                raise RuntimeError("pose estimation failed:\n" + value)
+            if kind == "failed":
+                video, tb = value
+                logger.error("could not analyze %s, skipping it:\n%s", video, tb)
+                self.failed.add(video)
+            remaining -= 1
+
+    def close(self):
+        for _ in self.workers:
+            self.task_q.put(None)
+        for w in self.workers:
+            w.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            for w in self.workers:
+                w.terminate()
+        self.close()
+
+
+def get_pending_tasks(config, session_path, videos=None):
+    """
+    Returns the (video, outdir) pairs of the videos of the session which
+    don't have a pose file yet.
+    `videos` may be given to skip listing the raw videos folder.
+    """
+    pipeline_videos_raw = config["pipeline"]["videos_raw"]
+    pipeline_pose = config["pipeline"]["pose_2d"]
 
     source_folder = os.path.join(session_path, pipeline_videos_raw)
     outdir = os.path.join(session_path, pipeline_pose)
 
-    videos = glob(os.path.join(source_folder, "*.avi"))
+    if videos is None:
+        videos = glob(os.path.join(source_folder, "*.avi"))
     videos = sorted(videos, key=natural_keys)
 
-    if len(videos) > 0:
-        os.makedirs(outdir, exist_ok=True)
+    if len(videos) == 0:
+        return []
 
-    videos_in_chunks = np.array_split(videos, n_gpus)
+    os.makedirs(outdir, exist_ok=True)
 
-    with Pool(n_gpus) as p:
-        p.starmap(
-            process_gpu_batch,
-            zip(repeat(config_name), videos_in_chunks, repeat(outdir), gpus),
-        )
+    done = {os.path.splitext(fname)[0] for fname in list_files(outdir, ".h5")}
+    return [(video, outdir) for video in videos if true_basename(video) not in done]
 
 
-def process_gpu_batch(config_name, videos, outdir, gpu=None):
+def analyze_tasks(config, tasks, workers=None):
+    if len(tasks) == 0:
+        return
 
-    for video in videos:
-        basename = os.path.basename(video)
-        basename, ext = os.path.splitext(basename)
+    if workers is not None:
+        workers.analyze(tasks)
+    else:
+        # no point in starting more workers than there are videos
+        with PoseWorkers(config, max_workers=len(tasks)) as workers:
+            workers.analyze(tasks)
 
-        dataname = os.path.join(outdir, basename + ".h5")
-        print(dataname)
-        if os.path.exists(dataname):
-            continue
-        else:
-            trap = io.StringIO()
-            with redirect_stdout(trap):
-                deeplabcut.analyze_videos(
-                    config_name,
-                    [video],
-                    videotype=ext,
-                    save_as_csv=True,
-                    destfolder=outdir,
-                    gputouse=gpu,
-                )
-        rename_dlc_files(outdir, basename)
+
+def process_session(config, session_path, workers=None, videos=None):
+    """
+    Analyzes the videos of the session which don't have a pose file yet.
+    `videos` may be given to skip listing the raw videos folder.
+    """
+    analyze_tasks(config, get_pending_tasks(config, session_path, videos), workers)
+
+
+def log_task(video, outdir):
+    logger.info("analyzing %s", os.path.join(outdir, true_basename(video) + ".h5"))
+
+
+def iter_tasks(task_q):
+    while True:
+        task = task_q.get()
+        if task is None:
+            return
+        log_task(*task)
+        yield task
+
+
+def iter_task_batches(task_q, first):
+    """
+    Yields lists of (video, outdir) tasks, starting with `first`. Each list
+    holds the tasks already waiting on `task_q`, only blocking when it is
+    empty, until the None sentinel.
+    """
+    batch = [first]
+    while True:
+        stop = False
+        while True:
+            try:
+                task = task_q.get_nowait()
+            except Empty:
+                break
+            if task is None:
+                stop = True
+                break
+            batch.append(task)
+
+        for task in batch:
+            log_task(*task)
+        yield batch
+
+        if stop:
+            return
+        task = task_q.get()
+        if task is None:
+            return
+        batch = [task]
+
+
+def process_gpu_queue(config_name, task_q, done_q, gpu=None, options=None):
+    # spawned workers don't inherit the logging setup
+    setup_logging()
+    try:
+        analyze_gpu_queue(config_name, task_q, done_q, gpu, options)
+    except Exception:
+        done_q.put(("error", traceback.format_exc()))
+        raise
+    finally:
+        # worker processes exit without running the logging shutdown
+        flush_logging()
+
+
+def analyze_gpu_queue(config_name, task_q, done_q, gpu=None, options=None):
+    if options is None:
+        options = dict()
+
+    def callback(video, outdir):
+        done_q.put(("done", video))
+
+    def error_callback(video, outdir, e):
+        tb = traceback.format_exception(type(e), e, e.__traceback__)
+        done_q.put(("failed", (video, "".join(tb))))
+
+    # don't load the network until there is a video to analyze
+    first = task_q.get()
+    if first is None:
+        return
+
+    try:
+        with suppress_output():
+            predictor = PosePredictor(config_name, gpu, **options)
+    except (ImportError, AttributeError, TypeError, KeyError) as e:
+        # the predictor relies on deeplabcut internals, which may not
+        # match this version of deeplabcut
+        logger.warning("falling back on deeplabcut.analyze_videos: %r", e)
+        predictor = None
+
+    if predictor is not None:
+        log_task(*first)
+        predictor.analyze(chain([first], iter_tasks(task_q)), callback, error_callback)
+        return
+
+    # fall back on deeplabcut, with one call per batch of waiting videos
+    # (and output folder), as each call loads the network again
+    kwargs = dict()
+    if options.get("batch_size", None) is not None:
+        kwargs["batchsize"] = options["batch_size"]
+
+    if options.get("frame_stride", 1) != 1 or options.get("scale", 1) != 1:
+        logger.warning(
+            "deeplabcut.analyze_videos tracks every frame at full resolution, "
+            "ignoring frame_stride and inference_scale"
+        )
+
+    def analyze(videos, outdir, ext):
+        with suppress_output():
+            deeplabcut.analyze_videos(
+                config_name,
+                videos,
+                videotype=ext,
+                save_as_csv=True,
+                destfolder=outdir,
+                gputouse=gpu,
+                **kwargs
+            )
+        rename_dlc_files(outdir, [true_basename(video) for video in videos])
+        for video in videos:
+            callback(video, outdir)
+
+    for batch in iter_task_batches(task_q, first):
+        groups = dict()
+        for video, outdir in batch:
+            _, ext = os.path.splitext(video)
+            groups.setdefault((outdir, ext), []).append(video)
+
+        for (outdir, ext), videos in groups.items():
+            try:
+                analyze(videos, outdir, ext)
+            except Exception as e:
+                if len(videos) == 1:
+                    error_callback(videos[0], outdir, e)
+                    continue
+                # find out which videos are broken, one at a time
+                for video in videos:
+                    try:
+                        analyze([video], outdir, ext)
+                    except Exception as e:
+                        error_callback(video, outdir, e)
 
 
-pose_videos_all = make_process_fun(process_session)
+def pose_videos_all(config):
+    # queue the videos of all sessions at once, so each gpu loads the
+    # network once and no gpu waits for a session to finish
+    tasks = list(chain.from_iterable(process_all(config, get_pending_tasks).values()))
+    analyze_tasks(config, tasks)
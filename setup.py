@@ -30,9 +30,9 @@ setuptools.setup(
         "scipy",
         "pandas",
         "tqdm",
-        "click",
+        "click>=8.0",
         "scikit-video",
         "checkerboard",
     ],
-    extras_require={"viz": ["mayavi"]},
+    extras_require={"viz": ["mayavi"], "watch": ["watchdog"], "decord": ["decord"], "av": ["av"]},
 )